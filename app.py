@@ -1,11 +1,23 @@
 import os
+import hmac
+import time
+import zlib
+import fcntl
+import atexit
+import struct
 import sqlite3
+import itertools
+import threading
+import orjson
 import requests
 import subprocess
 import socket
-from datetime import datetime
-from flask import Flask, request, jsonify, g
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from flask import Flask, Response, request, g
 from functools import wraps
+from requests.adapters import HTTPAdapter
+from apscheduler.executors.pool import ThreadPoolExecutor as JobExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 
 # --- CONFIG ---
@@ -13,6 +25,9 @@ DB_PATH = os.environ.get("DB_PATH", "/app/monitor.db")
 API_TOKEN = os.environ.get("API_TOKEN", "change_this_to_a_random_token")
 CHECK_INTERVAL_SECONDS = int(os.environ.get("CHECK_INTERVAL_SECONDS", "60"))
 HTTP_CHECK_PATH = os.environ.get("HTTP_CHECK_PATH", "/health")
+CHECKS_RETENTION_DAYS = int(os.environ.get("CHECKS_RETENTION_DAYS", "30"))
+IP_HEARTBEAT_SECONDS = int(os.environ.get("IP_HEARTBEAT_SECONDS", "900"))
+SCHEDULER_LOCK_PATH = os.environ.get("SCHEDULER_LOCK_PATH", "/tmp/aws-internet-observer.lock")
 
 app = Flask(__name__)
 
@@ -22,38 +37,80 @@ def ensure_db_dir():
     if db_dir and not os.path.exists(db_dir):
         os.makedirs(db_dir, exist_ok=True)
 
+# per connection pragmas; WAL is persisted in the db file and set in init_db.
+# busy_timeout goes first so the others already wait on a locked db
+SQLITE_PRAGMAS = """
+PRAGMA busy_timeout=5000;
+PRAGMA synchronous=NORMAL;
+PRAGMA cache_size=-20000;
+PRAGMA temp_store=MEMORY;
+"""
+
+def _connect():
+    ensure_db_dir()
+    # autocommit mode, write paths open their transactions explicitly
+    db = sqlite3.connect(
+        DB_PATH,
+        isolation_level=None,
+        check_same_thread=False
+    )
+    db.executescript(SQLITE_PRAGMAS)
+    db.row_factory = sqlite3.Row
+    return db
+
 def get_db():
     db = getattr(g, "_database", None)
     if db is None:
-        ensure_db_dir()
-        db = g._database = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
-        db.row_factory = sqlite3.Row
+        _ensure_db()
+        db = g._database = _connect()
     return db
 
 def init_db():
-    ensure_db_dir()
-    db = sqlite3.connect(DB_PATH)
+    db = _connect()
     cur = db.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
     cur.executescript("""
     CREATE TABLE IF NOT EXISTS ip_current (
       id INTEGER PRIMARY KEY,
       ip TEXT,
-      updated_at TIMESTAMP
+      updated_at INTEGER
     );
     CREATE TABLE IF NOT EXISTS checks (
       id INTEGER PRIMARY KEY,
       ip TEXT,
-      time TIMESTAMP,
+      time INTEGER,
       reachable INTEGER,
       method TEXT,
       detail TEXT
     );
+    -- older databases stored timestamps as text, convert them to µs since epoch
+    UPDATE ip_current SET updated_at = CAST(ROUND((julianday(updated_at) - 2440587.5) * 86400000) AS INTEGER) * 1000
+      WHERE typeof(updated_at) = 'text';
+    UPDATE checks SET time = CAST(ROUND((julianday(time) - 2440587.5) * 86400000) AS INTEGER) * 1000
+      WHERE typeof(time) = 'text';
+    CREATE INDEX IF NOT EXISTS idx_checks_time_desc ON checks(time DESC);
+    CREATE INDEX IF NOT EXISTS idx_checks_method_time ON checks(method, time DESC);
+    ANALYZE;
     """)
     db.commit()
     db.close()
 
-# init DB immediately (important for gunicorn)
-init_db()
+# schema is created lazily, once per process, on first use
+_db_ready = False
+_db_ready_lock = threading.Lock()
+
+def _ensure_db():
+    global _db_ready
+    if _db_ready:
+        return
+    with _db_ready_lock:
+        if not _db_ready:
+            init_db()
+            _db_ready = True
+
+# single long-lived writer for the scheduler, request handlers use their own
+_writer_conn = None
+_writer_lock = threading.Lock()
 
 @app.teardown_appcontext
 def close_connection(exception):
@@ -61,17 +118,78 @@ def close_connection(exception):
     if db is not None:
         db.close()
 
+# --- TIME HELPERS ---
+# timestamps are stored as integer microseconds since epoch (UTC)
+def _now_us():
+    return time.time_ns() // 1000
+
+def _iso(us):
+    if us is None:
+        return None
+    return datetime.fromtimestamp(us / 1e6, tz=timezone.utc).isoformat()
+
+# --- DETAIL STORAGE ---
+# long probe details are stored as a zlib compressed BLOB in the same
+# column, short ones stay TEXT; the storage class tells them apart
+DETAIL_COMPRESS_MIN = 256
+
+def _pack_detail(detail):
+    detail = detail[:2000]
+    if len(detail) > DETAIL_COMPRESS_MIN:
+        return zlib.compress(detail.encode())
+    return detail
+
+def _unpack_detail(detail):
+    if isinstance(detail, bytes):
+        return zlib.decompress(detail).decode(errors="replace")
+    return detail
+
+# --- JSON RESPONSES ---
+def _json(payload, status=200):
+    return Response(orjson.dumps(payload), status=status, mimetype="application/json")
+
+# --- RESPONSE CACHE ---
+# status/history only change when rows are written. The writes can happen on
+# other connections or in another process, so the cache version is sqlite's
+# data_version as seen by one long-lived connection: it changes whenever any
+# other connection commits, and reading it costs no query planning or I/O
+_cache = {}
+_cache_lock = threading.Lock()
+_version_conn = None
+
+def _data_version():
+    global _version_conn
+    # caller holds _cache_lock, which also serializes use of _version_conn
+    if _version_conn is None:
+        _ensure_db()
+        _version_conn = _connect()
+    return _version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+def _cached_json(key, build):
+    with _cache_lock:
+        current = _data_version()
+        body, version = _cache.get(key, (None, None))
+    if version != current:
+        body = orjson.dumps(build())
+        with _cache_lock:
+            _cache[key] = (body, current)
+    return Response(body, mimetype="application/json")
+
 # --- API ENDPOINTS ---
 def _auth_failed():
-    return jsonify({"error": "unauthorized"}), 401
+    return _json({"error": "unauthorized"}, 401)
 
 
+_BEARER = b"Bearer "
+_TOKEN_BYTES = API_TOKEN.encode()
+
 def require_token(f):
     """Decorator to require the bearer token on API endpoints."""
     @wraps(f)
     def wrapper(*args, **kwargs):
-        auth = request.headers.get("Authorization", "")
-        if not auth.startswith("Bearer ") or auth.split(" ", 1)[1] != API_TOKEN:
+        auth = request.headers.get("Authorization", "").encode()
+        # constant-time compare so the token can't be guessed byte by byte
+        if auth[:7] != _BEARER or not hmac.compare_digest(auth[7:], _TOKEN_BYTES):
             return _auth_failed()
         return f(*args, **kwargs)
     return wrapper
@@ -83,111 +201,267 @@ def update_ip():
     data = request.get_json(force=True, silent=True) or {}
     ip = data.get("ip") or request.remote_addr
     if not ip:
-        return jsonify({"error": "no ip provided"}), 400
+        return _json({"error": "no ip provided"}, 400)
 
     db = get_db()
     cur = db.cursor()
-    cur.execute("INSERT OR REPLACE INTO ip_current (id, ip, updated_at) VALUES (1, ?, ?)", (ip, datetime.utcnow()))
+    now_us = _now_us()
+    # same ip and recently refreshed -> skip the write, only heartbeat now and then
+    cur.execute("SELECT ip, updated_at FROM ip_current WHERE id = 1")
+    row = cur.fetchone()
+    if (row and row["ip"] == ip and row["updated_at"] is not None
+            and now_us - row["updated_at"] < IP_HEARTBEAT_SECONDS * 1_000_000):
+        return _json({"ok": True, "ip": ip, "timestamp": _iso(row["updated_at"]), "unchanged": True})
+
+    cur.execute("INSERT OR REPLACE INTO ip_current (id, ip, updated_at) VALUES (1, ?, ?)", (ip, now_us))
     db.commit()
-    return jsonify({"ok": True, "ip": ip, "timestamp": datetime.utcnow().isoformat()}), 200
+    return _json({"ok": True, "ip": ip, "timestamp": _iso(now_us)})
 
 @app.route("/ip/status", methods=["GET"])
 @require_token
 def status():
+    return _cached_json("status", _build_status)
+
+def _build_status():
     db = get_db()
     cur = db.cursor()
-    cur.execute("SELECT ip, updated_at FROM ip_current WHERE id = 1")
+    # current ip and latest check in one statement, always returns one row
+    cur.execute("""
+    SELECT cur.id AS ip_id, cur.ip, cur.updated_at,
+           last.time, last.reachable, last.method, last.detail
+    FROM (SELECT 1)
+    LEFT JOIN ip_current AS cur ON cur.id = 1
+    LEFT JOIN (
+      SELECT time, reachable, method, detail FROM checks ORDER BY time DESC LIMIT 1
+    ) AS last ON 1
+    """)
     row = cur.fetchone()
-    cur.execute("SELECT time, reachable, method, detail FROM checks ORDER BY time DESC LIMIT 1")
-    last = cur.fetchone()
-    if not row:
-        return jsonify({"status": "no-ip", "last_check": dict(last) if last else None})
-    return jsonify({
+    last = None
+    if row["time"] is not None:
+        last = {
+            "time": _iso(row["time"]),
+            "reachable": row["reachable"],
+            "method": row["method"],
+            "detail": _unpack_detail(row["detail"])
+        }
+    if row["ip_id"] is None:
+        return {"status": "no-ip", "last_check": last}
+    return {
         "current_ip": row["ip"],
-        "ip_updated_at": row["updated_at"],
-        "last_check": dict(last) if last else None
-    })
+        "ip_updated_at": _iso(row["updated_at"]),
+        "last_check": last
+    }
 
 @app.route("/ip/history", methods=["GET"])
 @require_token
 def history():
+    return _cached_json("history", _build_history)
+
+def _build_history():
     db = get_db()
     cur = db.cursor()
+    # plain tuples, the dicts are built once here instead of via sqlite3.Row
+    cur.row_factory = None
     cur.execute("SELECT time, ip, reachable, method, detail FROM checks ORDER BY time DESC LIMIT 200")
-    rows = [dict(r) for r in cur.fetchall()]
-    return jsonify(rows)
+    return [
+        {"time": _iso(t), "ip": ip, "reachable": reachable, "method": method, "detail": _unpack_detail(detail)}
+        for t, ip, reachable, method, detail in cur.fetchall()
+    ]
 
 # --- CHECK FUNCTIONS ---
-def ping_icmp(ip, timeout=2):
+_icmp_seq = itertools.count(1)
+
+def _icmp_checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def _icmp_echo(sock, ip, timeout):
+    """Send one echo request, return the rtt in ms or None on timeout."""
+    # on datagram ICMP sockets the kernel rewrites the id, so match on seq only
+    seq = next(_icmp_seq) & 0xffff
+    header = struct.pack("!BBHHH", 8, 0, 0, 0, seq)
+    payload = b"aws-internet-observer"
+    chksum = _icmp_checksum(header + payload)
+    packet = struct.pack("!BBHHH", 8, 0, chksum, 0, seq) + payload
+
+    start = time.monotonic()
+    deadline = start + timeout
+    sock.sendto(packet, (ip, 0))
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        sock.settimeout(remaining)
+        try:
+            data = sock.recv(1024)
+        except socket.timeout:
+            return None
+        if len(data) >= 8:
+            rtype, _, _, _, rseq = struct.unpack("!BBHHH", data[:8])
+            if rtype == 0 and rseq == seq:
+                return (time.monotonic() - start) * 1000
+
+_PING_ARGV = ["ping", "-c", "2", "-W"]
+
+def _ping_subprocess(ip, timeout):
+    # only the exit code matters, don't pipe and decode ping's output
     try:
         res = subprocess.run(
-            ["ping", "-c", "2", "-W", str(timeout), ip],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            _PING_ARGV + [str(timeout), ip],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=timeout * 3
         )
-        ok = res.returncode == 0
-        detail = res.stdout.decode(errors="ignore")[:2000]
-        return ok, detail
+        return res.returncode == 0, f"rc={res.returncode}"
     except Exception as e:
         return False, str(e)
 
-def tcp_connect(ip, port=80, timeout=3):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(timeout)
+def ping_icmp(ip, timeout=2):
+    if ":" in ip:
+        return _ping_subprocess(ip, timeout)
     try:
-        s.connect((ip, port))
-        s.close()
-        return True, f"tcp:{port} ok"
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    except OSError:
+        # unprivileged ICMP not allowed (net.ipv4.ping_group_range) -> system ping
+        return _ping_subprocess(ip, timeout)
+    try:
+        with sock:
+            rtt = _icmp_echo(sock, ip, timeout)
     except Exception as e:
         return False, str(e)
+    if rtt is None:
+        return False, f"no reply within {timeout}s"
+    return True, f"rtt={rtt:.1f}ms"
+
+def tcp_connect(ip, port=80, timeout=3):
+    # create_connection handles IPv6 targets, the with block closes the fd on errors too
+    try:
+        with socket.create_connection((ip, port), timeout=timeout):
+            return True, f"tcp:{port} ok"
+    except OSError as e:
+        return False, str(e)
+
+# keep-alive session so the http probe reuses its connection between ticks
+_http = requests.Session()
+_http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0))
 
 def http_get(ip, path=HTTP_CHECK_PATH, timeout=5):
     url = f"http://{ip}{path}"
     try:
-        r = requests.get(url, timeout=timeout)
+        r = _http.get(url, timeout=timeout)
         return (r.status_code == 200), f"status:{r.status_code}"
     except Exception as e:
         return False, str(e)
 
+# probes are I/O bound, run them side by side instead of one after another
+_probe_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="probe")
+PROBE_TIMEOUT_SECONDS = 15
+
 def do_check():
-    # separate connection because scheduler runs outside request ctx
-    ensure_db_dir()
-    db = sqlite3.connect(DB_PATH)
-    cur = db.cursor()
-    cur.execute("SELECT ip FROM ip_current WHERE id = 1")
-    row = cur.fetchone()
+    # scheduler runs outside request ctx -> use the shared writer connection
+    with _writer_lock:
+        cur = _writer_conn.cursor()
+        cur.execute("SELECT ip FROM ip_current WHERE id = 1")
+        row = cur.fetchone()
     if not row:
-        db.close()
         return
     ip = row[0]
-    ts = datetime.utcnow()
-
-    ok, detail = ping_icmp(ip)
-    cur.execute(
-        "INSERT INTO checks (ip, time, reachable, method, detail) VALUES (?, ?, ?, ?, ?)",
-        (ip, ts, int(ok), "icmp", detail[:2000])
-    )
+    ts = _now_us()
 
+    probes = [("icmp", _probe_pool.submit(ping_icmp, ip))]
     for port in (80, 443):
-        ok2, d2 = tcp_connect(ip, port=port)
-        cur.execute(
-            "INSERT INTO checks (ip, time, reachable, method, detail) VALUES (?, ?, ?, ?, ?)",
-            (ip, ts, int(ok2), f"tcp:{port}", d2[:2000])
-        )
+        probes.append((f"tcp:{port}", _probe_pool.submit(tcp_connect, ip, port=port)))
+    probes.append(("http", _probe_pool.submit(http_get, ip)))
 
-    ok3, d3 = http_get(ip)
-    cur.execute(
-        "INSERT INTO checks (ip, time, reachable, method, detail) VALUES (?, ?, ?, ?, ?)",
-        (ip, ts, int(ok3), "http", d3[:2000])
-    )
+    rows = []
+    for method, fut in probes:
+        try:
+            ok, detail = fut.result(timeout=PROBE_TIMEOUT_SECONDS)
+        except Exception as e:
+            ok, detail = False, str(e) or type(e).__name__
+        rows.append((ip, ts, int(ok), method, _pack_detail(detail)))
 
-    db.commit()
-    db.close()
+    # one transaction for all rows of a cycle -> single journal sync
+    with _writer_lock:
+        cur = _writer_conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.executemany(
+                "INSERT INTO checks (ip, time, reachable, method, detail) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+        except Exception:
+            # don't leave the shared connection stuck inside a transaction
+            _writer_conn.rollback()
+            raise
+        _writer_conn.commit()
+
+def _retention():
+    # only the latest rows are ever read, drop old checks and shrink the WAL
+    with _writer_lock:
+        cur = _writer_conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cutoff = _now_us() - CHECKS_RETENTION_DAYS * 86400 * 1_000_000
+            cur.execute("DELETE FROM checks WHERE time < ?", (cutoff,))
+        except Exception:
+            _writer_conn.rollback()
+            raise
+        _writer_conn.commit()
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
 
 # --- SCHEDULER ---
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=do_check, trigger="interval", seconds=CHECK_INTERVAL_SECONDS)
-scheduler.start()
+# Nothing starts on import: gunicorn.conf.py calls _start_background() from
+# its post_worker_init hook. Intended deployment is a single threaded worker.
+# If more workers are started anyway (or old and new worker overlap during a
+# reload), the flock makes sure only one of them runs the checks and owns the
+# writer; the others wait and take over when it exits.
+
+# one job thread: checks and retention never overlap on the writer
+scheduler = BackgroundScheduler(executors={"default": JobExecutor(1)})
+_scheduler_lock_file = None
+
+def _start_background():
+    lock_file = open(SCHEDULER_LOCK_PATH, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # another process runs the scheduler, e.g. the old worker during a
+        # gunicorn reload. Wait for the lock in the background and take over
+        # once that process is gone.
+        threading.Thread(
+            target=_wait_for_scheduler_lock, args=(lock_file,),
+            name="scheduler-lock", daemon=True
+        ).start()
+        return False
+    _run_scheduler(lock_file)
+    return True
+
+def _wait_for_scheduler_lock(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    _run_scheduler(lock_file)
+
+def _run_scheduler(lock_file):
+    global _scheduler_lock_file, _writer_conn
+    # keep the file open for the lifetime of the process to hold the lock
+    _scheduler_lock_file = lock_file
+
+    _ensure_db()
+    _writer_conn = _connect()
+    atexit.register(_writer_conn.close)
+
+    # slow cycles drop missed ticks instead of queueing them up
+    job_opts = {"max_instances": 1, "coalesce": True, "misfire_grace_time": 30}
+    scheduler.add_job(func=do_check, trigger="interval", seconds=CHECK_INTERVAL_SECONDS, id="probe", **job_opts)
+    # run retention right away too, the scheduler restarts on every deploy/reload
+    # and a plain 24h interval might then never fire
+    scheduler.add_job(
+        func=_retention, trigger="interval", hours=24, id="retention",
+        next_run_time=datetime.now(timezone.utc), **job_opts
+    )
+    scheduler.start()
 
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
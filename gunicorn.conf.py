@@ -0,0 +1,17 @@
+# gunicorn settings for the observer API
+#
+# One worker with a thread pool: the endpoints are short SQLite reads that
+# release the GIL, and the scheduler, the writer connection and the response
+# cache all live inside that single process.
+# preload_app stays off and the scheduler is started from post_worker_init,
+# so it runs in the worker that also serves the requests, not in the master.
+bind = "0.0.0.0:5000"
+workers = 1
+worker_class = "gthread"
+threads = 16
+preload_app = False
+
+
+def post_worker_init(worker):
+    from app import _start_background
+    _start_background()